@@ -1,7 +1,21 @@
-from fastapi import FastAPI, Form
+from fastapi import FastAPI, Form, Request, Header, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
+from pydantic import BaseModel
+from typing import List, Optional
+from collections import deque, OrderedDict
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
 import os
 import logging
+import struct
+import threading
+import time
+import zlib
 from datetime import datetime
 
 # ログ設定
@@ -28,17 +42,606 @@ except ImportError as e:
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "gcp-handson-30days-30010")
 LOCATION = "us-central1"
 
+# スケジューラ設定（Gemini 同時実行数の上限と優先度クラス別の上限）
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "4"))
+INTERACTIVE_MAX_CONCURRENCY = int(os.getenv("INTERACTIVE_MAX_CONCURRENCY", str(MAX_CONCURRENT_GENERATIONS)))
+# バッチは最低1枠をインタラクティブ用に残す
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", str(max(1, MAX_CONCURRENT_GENERATIONS - 1))))
+# クライアント/APIキー別の重み（例: "team-a:3,team-b:1"）
+CLIENT_WEIGHTS = os.getenv("CLIENT_WEIGHTS", "")
+# API からインタラクティブ優先度を指定できる APIキー（カンマ区切り）。未指定なら UI のみ
+INTERACTIVE_API_KEYS = {key.strip() for key in os.getenv("INTERACTIVE_API_KEYS", "").split(",") if key.strip()}
+
+# リクエスト期限（秒）とクライアント切断の監視間隔
+GENERATION_TIMEOUT_SECONDS = float(os.getenv("GENERATION_TIMEOUT_SECONDS", "120"))
+MAX_GENERATION_TIMEOUT_SECONDS = float(os.getenv("MAX_GENERATION_TIMEOUT_SECONDS", "300"))
+DISCONNECT_POLL_INTERVAL = 0.5
+# キャンセル後にワーカーの停止を待つ上限（秒）。超えたら実行枠を解放する
+CANCEL_GRACE_SECONDS = float(os.getenv("CANCEL_GRACE_SECONDS", "10"))
+
+# サーキットブレーカー設定
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "90"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+# 生成済み記事の保持件数（ブレーカー作動中のフォールバックに使用）
+ARTICLE_STORE_SIZE = int(os.getenv("ARTICLE_STORE_SIZE", "256"))
+
+# 生成トラフィックの記録・再生（記録ファイルのパス、再生速度倍率。0 は待機なし）
+GENERATION_RECORD_PATH = os.getenv("GENERATION_RECORD_PATH", "")
+GENERATION_REPLAY_PATH = os.getenv("GENERATION_REPLAY_PATH", "")
+GENERATION_REPLAY_SPEED = float(os.getenv("GENERATION_REPLAY_SPEED", "1.0"))
+
+# 派生コンテンツ（要約・翻訳など）用の軽量モデルと同時実行数、キャッシュ件数
+DERIVE_MODEL_NAME = os.getenv("DERIVE_MODEL_NAME", "gemini-2.5-flash")
+DERIVE_MAX_CONCURRENCY = int(os.getenv("DERIVE_MAX_CONCURRENCY", "8"))
+DERIVED_CACHE_SIZE = int(os.getenv("DERIVED_CACHE_SIZE", "1024"))
+
+# 派生フォーマット: 記事本文に付ける短い指示と出力トークン上限
+# 2.5 系モデルは思考トークンも max_output_tokens に含まれるため、出力長より十分大きく取る
+DERIVED_FORMATS = {
+    "sns": {
+        "instruction": "以下のブログ記事を、SNS投稿用に140文字以内の日本語で要約してください。ハッシュタグを2つまで付けてください。要約のみを出力してください。",
+        "max_output_tokens": 2048
+    },
+    "summary": {
+        "instruction": "以下のブログ記事の要点を、300文字程度の日本語の箇条書きでまとめてください。まとめのみを出力してください。",
+        "max_output_tokens": 2048
+    },
+    "en": {
+        "instruction": "Translate the following Japanese blog article into natural English. Keep the Markdown structure. Output only the translation.",
+        "max_output_tokens": 8192
+    }
+}
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+
+CANCEL_REASON_DEADLINE = "deadline"
+CANCEL_REASON_DISCONNECT = "client_disconnect"
+
+
+class CancellationStats:
+    """キャンセルされた生成処理の集計（スレッドから更新されるためロックで保護）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_reason = {CANCEL_REASON_DEADLINE: 0, CANCEL_REASON_DISCONNECT: 0}
+        self.while_queued = 0
+        self.while_running = 0
+        self.aborted_streams = 0
+        self.discarded_chunks = 0
+        self.discarded_chars = 0
+        self.discarded_model_seconds = 0.0
+        self.uncancellable_streams = 0
+        self.abandoned_workers = 0
+
+    def record_cancel(self, reason: str, queued: int, running: int):
+        with self._lock:
+            self.by_reason[reason] = self.by_reason.get(reason, 0) + queued + running
+            self.while_queued += queued
+            self.while_running += running
+
+    def record_aborted_stream(self, chunks: int, chars: int, elapsed: float):
+        with self._lock:
+            self.aborted_streams += 1
+            self.discarded_chunks += chunks
+            self.discarded_chars += chars
+            self.discarded_model_seconds += elapsed
+
+    def record_uncancellable_stream(self):
+        with self._lock:
+            self.uncancellable_streams += 1
+
+    def record_abandoned_worker(self):
+        with self._lock:
+            self.abandoned_workers += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "by_reason": dict(self.by_reason),
+                "while_queued": self.while_queued,
+                "while_running": self.while_running,
+                "aborted_streams": self.aborted_streams,
+                "discarded_chunks": self.discarded_chunks,
+                "discarded_chars": self.discarded_chars,
+                "discarded_model_seconds": round(self.discarded_model_seconds, 2),
+                "uncancellable_streams": self.uncancellable_streams,
+                "abandoned_workers": self.abandoned_workers
+            }
+
+cancellation_stats = CancellationStats()
+
+
+def _cancel_detail(reason: str) -> str:
+    """キャンセル理由の表示用メッセージ"""
+    return "リクエスト期限を超過しました" if reason == CANCEL_REASON_DEADLINE else "クライアントが切断されました"
+
+
+def _cancelled_result(topic: str, reason: str) -> dict:
+    """キャンセル時のレスポンス"""
+    detail = _cancel_detail(reason)
+    return {
+        "success": False,
+        "cancelled": True,
+        "cancel_reason": reason,
+        "error": f"生成を中断しました: {detail}",
+        "content": f"# {topic}\n\n生成を中断しました。\n\n詳細: {detail}",
+        "word_count": 0,
+        "source": "Cancelled"
+    }
+
+
+def _derive_result(article_id: str, fmt: str, **fields) -> dict:
+    """派生コンテンツの失敗・キャンセル時のレスポンス（成功時と同じキー構成）"""
+    return dict({"success": False, "content": "", "format": fmt, "article_id": article_id}, **fields)
+
+
+def _derive_cancelled_result(article_id: str, fmt: str, reason: str) -> dict:
+    return _derive_result(article_id, fmt, cancelled=True, cancel_reason=reason,
+                          error=f"生成を中断しました: {_cancel_detail(reason)}", source="Cancelled")
+
+
+def _chunk_text(chunk) -> str:
+    """テキストを持たないチャンク（思考のみ・候補なし等）は空文字として扱う"""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+def _abort_reason(cancel_event: Optional[threading.Event], deadline: Optional[float]) -> Optional[str]:
+    """生成を中断すべき理由（中断不要なら None）
+
+    期限切れ時も cancel_event はセットされるため、期限を先に判定する。
+    """
+    if deadline is not None and time.monotonic() >= deadline:
+        return CANCEL_REASON_DEADLINE
+    if cancel_event is not None and cancel_event.is_set():
+        return CANCEL_REASON_DISCONNECT
+    return None
+
+
+def _cancel_stream(responses) -> bool:
+    """モデルのストリームを消費スレッドの外から中断（成功したら True）"""
+    cancel = getattr(responses, "cancel", None)
+    if cancel is None:
+        # Vertex AI SDK はジェネレータ内のローカル変数に gRPC ストリームを保持している
+        frame = getattr(responses, "gi_frame", None)
+        stream = frame.f_locals.get("response_stream") if frame is not None else None
+        cancel = getattr(stream, "cancel", None)
+    if cancel is None:
+        return False
+    try:
+        cancel()
+    except Exception as e:
+        logger.warning(f"⚠️ ストリームのキャンセルに失敗: {str(e)}")
+        return False
+    return True
+
+
+class _StreamWatchdog:
+    """キャンセル・期限切れを監視し、チャンク待ちで止まっているストリームも中断する
+
+    チャンク間のチェックだけでは最初のチャンクが返らない呼び出しを止められないため、
+    別スレッドから gRPC ストリームをキャンセルする。
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, responses, cancel_event: Optional[threading.Event], deadline: Optional[float]):
+        self.responses = responses
+        self.cancel_event = cancel_event
+        self.deadline = deadline
+        self._finished = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        if self.cancel_event is not None or self.deadline is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._finished.set()
+
+    def _run(self):
+        reported = False
+        while not self._finished.wait(self.POLL_INTERVAL):
+            if not _abort_reason(self.cancel_event, self.deadline):
+                continue
+            if _cancel_stream(self.responses):
+                return
+            # ストリームがまだ生成されていない場合もあるため次の周期で再試行する（記録は1回のみ）
+            if not reported:
+                reported = True
+                cancellation_stats.record_uncancellable_stream()
+                logger.warning("⚠️ モデルのストリームを中断できません（次のチャンクまで停止しない可能性があります）")
+
+
+class CircuitBreaker:
+    """Vertex AI 呼び出し用サーキットブレーカー
+
+    連続失敗（または閾値超えの遅延）が続くと open になり、即座に失敗を返す。
+    一定時間後に half_open へ移行し、1件だけ試験的に通して復旧を確認する。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, slow_call_seconds: float,
+                 reset_seconds: float, window: int = 100):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.probe_started_at = None
+        self.open_count = 0
+        self.rejected = 0
+        self.last_error = None
+        self.recent = deque(maxlen=window)  # (成功したか, レイテンシ秒)
+
+    def allow(self) -> bool:
+        """モデル呼び出しを許可するか判定"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+                logger.info("🔶 サーキットブレーカー half-open: 復旧確認リクエストを送信")
+            if self.state == self.HALF_OPEN and self.probe_in_flight and \
+                    time.monotonic() - self.probe_started_at >= self.slow_call_seconds:
+                # 応答しない試験リクエストは失敗とみなして open に戻す
+                self._on_failure(f"試験リクエストが {self.slow_call_seconds:g}秒以内に完了しませんでした")
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                self.probe_started_at = time.monotonic()
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self, latency: float):
+        with self._lock:
+            # 閾値を超えた遅い呼び出しはエラー率にも失敗として計上する
+            self.recent.append((latency < self.slow_call_seconds, latency))
+            if latency >= self.slow_call_seconds:
+                self._on_failure(f"レイテンシ超過 ({latency:.1f}秒)")
+                return
+            self.consecutive_failures = 0
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+                self.probe_in_flight = False
+                logger.info("✅ サーキットブレーカー closed: Vertex AI 復旧")
+
+    def record_failure(self, latency: float, error: str):
+        with self._lock:
+            self.recent.append((False, latency))
+            self._on_failure(error)
+
+    def release_probe(self):
+        """結果を判定せずに終わった試験リクエスト（キャンセル等）の枠を戻す"""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def _on_failure(self, error: str):
+        self.consecutive_failures += 1
+        self.last_error = error
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.open_count += 1
+                logger.error(f"🔴 サーキットブレーカー open: {error}")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            outcomes = list(self.recent)
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = round(max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at)), 1)
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "recent_calls": len(outcomes),
+                "recent_error_rate": round(
+                    sum(1 for ok, _ in outcomes if not ok) / len(outcomes), 3
+                ) if outcomes else 0.0,
+                "latency_p95_seconds": round(_percentile([lat for _, lat in outcomes], 95), 2),
+                "open_count": self.open_count,
+                "rejected": self.rejected,
+                "retry_in_seconds": retry_in,
+                "last_error": self.last_error
+            }
+
+
+class ArticleStore:
+    """生成済み記事のインメモリ LRU ストア（スレッドから更新されるためロックで保護）"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._articles = OrderedDict()
+
+    @staticmethod
+    def article_id(topic: str, category: str, tone: str) -> str:
+        key = f"{topic}\x00{category}\x00{tone}".encode("utf-8")
+        return hashlib.sha1(key).hexdigest()[:16]
+
+    def put(self, result: dict) -> str:
+        article_id = self.article_id(result["topic"], result["category"], result["tone"])
+        with self._lock:
+            self._articles[article_id] = dict(result, article_id=article_id)
+            self._articles.move_to_end(article_id)
+            while len(self._articles) > self.max_size:
+                self._articles.popitem(last=False)
+        return article_id
+
+    def get(self, article_id: str) -> Optional[dict]:
+        with self._lock:
+            article = self._articles.get(article_id)
+            if article is not None:
+                self._articles.move_to_end(article_id)
+            return article
+
+    def find(self, topic: str, category: str, tone: str) -> Optional[dict]:
+        return self.get(self.article_id(topic, category, tone))
+
+    def __len__(self):
+        return len(self._articles)
+
+
+circuit_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_SLOW_CALL_SECONDS, BREAKER_RESET_SECONDS)
+# 派生コンテンツ用の軽量モデルは別のブレーカーで保護する
+derive_circuit_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_SLOW_CALL_SECONDS, BREAKER_RESET_SECONDS)
+article_store = ArticleStore(ARTICLE_STORE_SIZE)
+
+
+GENERATION_LOG_MAGIC = b"VBGREC1\n"
+_RECORD_HEADER = struct.Struct(">I")
+
+
+class GenerationRecorder:
+    """生成トラフィックの記録（長さプレフィックス付き・zlib 圧縮の JSON レコードを追記）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.recorded = 0
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.write(GENERATION_LOG_MAGIC)
+
+    def record(self, inputs: dict, trace: Optional[dict], outcome: str,
+               prompt: Optional[str] = None, started_at: Optional[float] = None,
+               chunks: list = (), chunk_offsets: list = (), duration: float = 0.0,
+               error: Optional[str] = None):
+        """1リクエスト分を記録
+
+        outcome は success / error / cancelled / rejected（ブレーカーによる拒否）。
+        trace には到着時刻・優先度・クライアントキー・期限が入り、負荷形状の再現に使う。
+        """
+        trace = trace or {}
+        payload = zlib.compress(json.dumps({
+            "inputs": inputs,
+            "arrived_at": trace.get("arrived_at", started_at),
+            "priority": trace.get("priority"),
+            "client": trace.get("client"),
+            "timeout": trace.get("timeout"),
+            "outcome": outcome,
+            "prompt": prompt,
+            "started_at": started_at,
+            "chunks": [[round(offset, 4), text] for offset, text in zip(chunk_offsets, chunks)],
+            "duration": round(duration, 4),
+            "error": error
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        with self._lock:
+            try:
+                with open(self.path, "ab") as f:
+                    f.write(_RECORD_HEADER.pack(len(payload)) + payload)
+                self.recorded += 1
+            except OSError as e:
+                logger.warning(f"⚠️ 生成トラフィックの記録に失敗: {e}")
+
+
+def read_generation_log(path: str):
+    """記録ファイルをメモリマップで読み出し、レコードを順に返す"""
+    with open(path, "rb") as f:
+        if os.path.getsize(path) <= len(GENERATION_LOG_MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(GENERATION_LOG_MAGIC)] != GENERATION_LOG_MAGIC:
+                raise ValueError(f"生成ログの形式が不正です: {path}")
+            pos = len(GENERATION_LOG_MAGIC)
+            while pos + _RECORD_HEADER.size <= len(data):
+                (length,) = _RECORD_HEADER.unpack_from(data, pos)
+                pos += _RECORD_HEADER.size
+                if pos + length > len(data):
+                    # 書き込み途中で終了したレコードは無視
+                    logger.warning(f"⚠️ 生成ログ末尾の不完全なレコードを無視: {path}")
+                    return
+                yield json.loads(zlib.decompress(data[pos:pos + length]))
+                pos += length
+
+
+class _ReplayChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _ReplayStream:
+    """記録済みチャンクを元の間隔で返すストリーム（gRPC ストリーム同様に外部から cancel 可能）"""
+
+    def __init__(self, record: dict, speed: float):
+        self.record = record
+        self.speed = speed
+        self._cancelled = threading.Event()
+        self._chunks = self._replay()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        self._chunks.close()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _wait_until(self, start: float, offset: float):
+        if self.speed > 0:
+            delay = start + offset / self.speed - time.monotonic()
+            if delay > 0:
+                self._cancelled.wait(delay)
+        if self._cancelled.is_set():
+            raise RuntimeError("再生ストリームがキャンセルされました")
+
+    def _replay(self):
+        start = time.monotonic()
+        for offset, text in self.record["chunks"]:
+            self._wait_until(start, offset)
+            yield _ReplayChunk(text)
+        if self.record.get("error"):
+            self._wait_until(start, self.record["duration"])
+            raise RuntimeError(f"記録されたエラーを再生: {self.record['error']}")
+
+
+def _record_outcome(record: dict) -> str:
+    # outcome を持たない旧形式の記録はエラー有無で判定
+    return record.get("outcome") or ("error" if record.get("error") else "success")
+
+
+def _inputs_key(inputs: Optional[dict]) -> Optional[str]:
+    return json.dumps(inputs, ensure_ascii=False, sort_keys=True) if inputs else None
+
+
+class ReplayModel:
+    """記録済みのレスポンスを返す GenerativeModel 互換の再生バックエンド
+
+    リクエスト内容（topic/category/tone）が一致する記録を優先し、次にプロンプトで照合する。
+    プロンプトには生成月が含まれるため、月をまたいだ再生でも入力で照合できる。
+    どちらも一致しない場合は警告を出して記録順に循環して使う。
+    speed=1.0 で元のチャンク間隔、2.0 で倍速、0 で待機なしに再生する。
+    """
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self.speed = speed
+        # キャンセル・拒否されたリクエストは応答を持たないため再生対象外
+        self.records = [r for r in read_generation_log(path) if _record_outcome(r) in ("success", "error")]
+        if not self.records:
+            raise ValueError(f"再生する記録がありません: {path}")
+        self._by_inputs = {}
+        self._by_prompt = {}
+        for record in self.records:
+            self._by_inputs.setdefault(_inputs_key(record["inputs"]), deque()).append(record)
+            self._by_prompt.setdefault(record["prompt"], deque()).append(record)
+        # 記録順の代替応答は種別（通常の記事 / 派生フォーマット）ごとに分ける
+        self._cursors = {}
+        for kind in {record["inputs"].get("format") for record in self.records}:
+            self._cursors[kind] = itertools.cycle(
+                [record for record in self.records if record["inputs"].get("format") == kind]
+            )
+        self.unmatched = 0
+        self._lock = threading.Lock()
+
+    def _select(self, prompt: str, inputs: Optional[dict] = None) -> dict:
+        with self._lock:
+            for index, key in ((self._by_inputs, _inputs_key(inputs)), (self._by_prompt, prompt)):
+                matches = index.get(key)
+                if matches:
+                    # 同じキーの記録が複数あれば順番に使う
+                    matches.rotate(-1)
+                    return matches[-1]
+            kind = (inputs or {}).get("format")
+            if kind not in self._cursors:
+                raise LookupError(f"再生できる記録がありません: {kind or '記事'}")
+            self.unmatched += 1
+            logger.warning(f"⚠️ 一致する記録がないため記録順の応答を使用: {inputs or prompt[:50]}")
+            return next(self._cursors[kind])
+
+    def can_replay(self, inputs: dict) -> bool:
+        """同じ種別（通常の記事 / 派生フォーマット）の記録があるか"""
+        return inputs.get("format") in self._cursors
+
+    def generate_content(self, prompt, generation_config=None, stream=False, inputs: Optional[dict] = None):
+        responses = _ReplayStream(self._select(prompt, inputs), self.speed)
+        if stream:
+            return responses
+        return _ReplayChunk("".join(chunk.text for chunk in responses))
+
+
+class DerivedContentCache:
+    """(記事, 本文ハッシュ, フォーマット) 単位の派生コンテンツ LRU キャッシュ"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(article: dict, fmt: str) -> tuple:
+        # 同じ記事IDで再生成された場合に古い派生を返さないよう本文ハッシュも含める
+        digest = hashlib.sha1(article["content"].encode("utf-8")).hexdigest()[:16]
+        return (article["article_id"], digest, fmt)
+
+    def get(self, key: tuple) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, result: dict):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+derived_cache = DerivedContentCache(DERIVED_CACHE_SIZE)
+
+
 class BlogGenerator:
     def __init__(self):
         self.available = False
         self.model = None
+        self.derive_model = None
         self.error_message = None
+        self.source = "Vertex AI Gemini 2.5 Pro"
+        self.recorder = None
         
-        if VERTEX_AI_AVAILABLE:
+        if GENERATION_REPLAY_PATH:
+            try:
+                self.model = ReplayModel(GENERATION_REPLAY_PATH, GENERATION_REPLAY_SPEED)
+                self.derive_model = self.model
+                self.available = True
+                self.source = "Replay (記録再生)"
+                logger.info(f"⏯️ リプレイモード: {len(self.model.records)}件の記録を {GENERATION_REPLAY_SPEED}倍速で再生")
+            except Exception as e:
+                self.error_message = str(e)
+                logger.error(f"❌ リプレイ記録の読み込み失敗: {e}")
+        elif VERTEX_AI_AVAILABLE:
             try:
                 logger.info("🚀 Vertex AI初期化中...")
                 vertexai.init(project=PROJECT_ID, location=LOCATION)
                 self.model = GenerativeModel("gemini-2.5-pro")
+                self.derive_model = GenerativeModel(DERIVE_MODEL_NAME)
                 self.available = True
                 logger.info("✅ Vertex AI Gemini 2.5 Pro 初期化完了")
             except Exception as e:
@@ -46,9 +649,21 @@ class BlogGenerator:
                 logger.error(f"❌ Vertex AI初期化失敗: {e}")
         else:
             self.error_message = "Vertex AI ライブラリが利用できません"
+        
+        if GENERATION_RECORD_PATH and self.available and not GENERATION_REPLAY_PATH:
+            self.recorder = GenerationRecorder(GENERATION_RECORD_PATH)
+            logger.info(f"⏺️ 生成トラフィックを記録中: {GENERATION_RECORD_PATH}")
     
-    def generate_blog(self, topic: str, category: str, tone: str):
-        """ブログ生成メソッド（1,500-2,000文字対応）"""
+    def generate_blog(self, topic: str, category: str, tone: str,
+                      cancel_event: Optional[threading.Event] = None,
+                      deadline: Optional[float] = None,
+                      trace: Optional[dict] = None):
+        """ブログ生成メソッド（1,500-2,000文字対応）
+
+        cancel_event がセットされるか deadline（time.monotonic 基準）を過ぎると、
+        ストリーミング中のモデル呼び出しを中断する（チャンク待ちの間も含む）。
+        trace（到着時刻・優先度・クライアントキー）は記録モードでのみ使う。
+        """
         if not self.available:
             return {
                 "success": False,
@@ -58,6 +673,22 @@ class BlogGenerator:
                 "source": "Error System"
             }
         
+        started_at = None
+        started_wall = None
+        prompt = None
+        chunks, chunk_offsets = [], []
+        inputs = {"topic": topic, "category": category, "tone": tone}
+
+        def record(outcome, **fields):
+            if self.recorder:
+                self.recorder.record(inputs, trace, outcome, prompt=prompt, started_at=started_wall,
+                                     chunks=chunks, chunk_offsets=chunk_offsets, **fields)
+
+        def aborted(reason):
+            record("cancelled", duration=time.monotonic() - started_at, error=reason)
+            self._aborted_stream(circuit_breaker, reason, chunks, started_at)
+            return _cancelled_result(topic, reason)
+
         try:
             # 現在の日付取得
             current_date = datetime.now().strftime("%Y年%m月")
@@ -132,35 +763,71 @@ class BlogGenerator:
 それでは、上記の条件に完全に従って、1,500-2,000文字の高品質なブログ記事を作成してください：
 """
             
-            # Gemini API呼び出し（長文生成用パラメータ調整）
-            response = self.model.generate_content(
-                prompt,
-                generation_config={
+            reason = _abort_reason(cancel_event, deadline)
+            if reason:
+                record("cancelled", error=reason)
+                return _cancelled_result(topic, reason)
+
+            # ブレーカー作動中はタイムアウトを待たずに即座にフォールバック
+            if not circuit_breaker.allow():
+                record("rejected")
+                return self._degraded_result(topic, category, tone)
+
+            # Gemini API呼び出し（長文生成用パラメータ調整、中断できるようストリーミング）
+            started_at = time.monotonic()
+            started_wall = time.time()
+            responses = self._stream(
+                self.model, prompt,
+                {
                     "max_output_tokens": 4096,  # 長文対応
                     "temperature": 0.8,  # 創造性を高める
                     "top_p": 0.9,
                     "top_k": 40
-                }
+                },
+                inputs
             )
             
-            content = response.text
+            # チャンク待ちで止まった場合もウォッチドッグがストリームを中断する
+            with _StreamWatchdog(responses, cancel_event, deadline):
+                for chunk in responses:
+                    reason = _abort_reason(cancel_event, deadline)
+                    if reason:
+                        # ストリームを閉じてモデル側の生成も止める
+                        responses.close()
+                        return aborted(reason)
+                    chunks.append(_chunk_text(chunk))
+                    chunk_offsets.append(time.monotonic() - started_at)
+            
+            content = "".join(chunks)
+            duration = time.monotonic() - started_at
+            circuit_breaker.record_success(duration)
+            record("success", duration=duration)
             word_count = len(content.replace(" ", ""))  # 日本語文字数
             
             logger.info(f"✅ 長文ブログ生成成功: {word_count}文字")
             
-            return {
+            result = {
                 "success": True,
                 "content": content,
-                "source": "Vertex AI Gemini 2.5 Pro",
+                "source": self.source,
                 "word_count": word_count,
                 "topic": topic,
                 "category": category,
                 "tone": tone
             }
+            result["article_id"] = article_store.put(result)
+            return result
             
         except Exception as e:
+            reason = _abort_reason(cancel_event, deadline) if started_at is not None else None
+            if reason:
+                # ウォッチドッグによるストリーム中断はエラーではなくキャンセルとして返す
+                return aborted(reason)
             error_msg = f"AI生成エラー: {str(e)}"
             logger.error(error_msg)
+            if started_at is not None:
+                circuit_breaker.record_failure(time.monotonic() - started_at, error_msg)
+                record("error", duration=time.monotonic() - started_at, error=str(e))
             return {
                 "success": False,
                 "error": error_msg,
@@ -169,8 +836,421 @@ class BlogGenerator:
                 "source": "Error"
             }
 
+    @staticmethod
+    def _stream(model, prompt: str, generation_config: dict, inputs: dict):
+        """ストリーミング呼び出し（再生バックエンドには記録との照合用に入力も渡す）"""
+        if isinstance(model, ReplayModel):
+            return model.generate_content(prompt, generation_config=generation_config, stream=True, inputs=inputs)
+        return model.generate_content(prompt, generation_config=generation_config, stream=True)
+
+    @staticmethod
+    def _aborted_stream(breaker: CircuitBreaker, reason: str, chunks: list, started_at: float):
+        """中断したストリームを集計する
+
+        期限内に応答しなかった呼び出しはブレーカーの失敗として計上し、
+        クライアント切断は試験リクエストの枠を戻すだけにする。
+        """
+        elapsed = time.monotonic() - started_at
+        if reason == CANCEL_REASON_DEADLINE:
+            breaker.record_failure(elapsed, f"リクエスト期限内に応答がありませんでした ({elapsed:.1f}秒)")
+        else:
+            breaker.release_probe()
+        cancellation_stats.record_aborted_stream(
+            len(chunks), sum(len(c) for c in chunks), elapsed
+        )
+        logger.warning(f"⏹️ ストリーミング生成を中断: {len(chunks)}チャンク破棄")
+
+    def derive(self, article_id: str, fmt: str,
+               cancel_event: Optional[threading.Event] = None,
+               deadline: Optional[float] = None,
+               trace: Optional[dict] = None):
+        """保存済み記事から要約・翻訳などの派生コンテンツを生成
+
+        元の長文プロンプトは使わず、記事本文と短い指示だけを軽量モデルに送る。
+        結果は (記事, 本文ハッシュ, フォーマット) 単位でキャッシュする。
+        """
+        article = article_store.get(article_id)
+        spec = DERIVED_FORMATS.get(fmt)
+        if article is None or spec is None:
+            error_msg = f"記事が見つかりません: {article_id}" if article is None else f"未対応のフォーマット: {fmt}"
+            return _derive_result(article_id, fmt, error=error_msg, source="Error")
+
+        cache_key = derived_cache.key(article, fmt)
+        cached = derived_cache.get(cache_key)
+        if cached is not None:
+            return dict(cached, cached=True)
+
+        if not self.available:
+            return _derive_result(article_id, fmt, error=f"Vertex AI利用不可: {self.error_message}",
+                                  source="Error System")
+
+        inputs = {"article_id": article_id, "format": fmt}
+        prompt = f"{spec['instruction']}\n\n---\n{article['content']}"
+        if isinstance(self.derive_model, ReplayModel) and not self.derive_model.can_replay(inputs):
+            # 記事本文の記録で代用すると要約・翻訳として誤った結果になるため拒否する
+            return _derive_result(article_id, fmt, error=f"再生モードでは記録されていない派生フォーマットは生成できません: {fmt}",
+                                  source="Replay")
+
+        started_at = None
+        started_wall = None
+        chunks, chunk_offsets = [], []
+
+        def record(outcome, **fields):
+            if self.recorder:
+                self.recorder.record(inputs, trace, outcome, prompt=prompt, started_at=started_wall,
+                                     chunks=chunks, chunk_offsets=chunk_offsets, **fields)
+
+        def aborted(reason):
+            record("cancelled", duration=time.monotonic() - started_at, error=reason)
+            self._aborted_stream(derive_circuit_breaker, reason, chunks, started_at)
+            return _derive_cancelled_result(article_id, fmt, reason)
+
+        try:
+            reason = _abort_reason(cancel_event, deadline)
+            if reason:
+                record("cancelled", error=reason)
+                return _derive_cancelled_result(article_id, fmt, reason)
+
+            # ブレーカー作動中は期限まで待たずに即座に失敗を返す
+            if not derive_circuit_breaker.allow():
+                record("rejected")
+                return _derive_result(article_id, fmt, error="軽量モデルが一時的に利用できません（サーキットブレーカー作動中）",
+                                      source="Circuit Breaker")
+
+            started_at = time.monotonic()
+            started_wall = time.time()
+            responses = self._stream(
+                self.derive_model, prompt,
+                {
+                    "max_output_tokens": spec["max_output_tokens"],
+                    "temperature": 0.3  # 元記事に忠実に
+                },
+                inputs
+            )
+            with _StreamWatchdog(responses, cancel_event, deadline):
+                for chunk in responses:
+                    reason = _abort_reason(cancel_event, deadline)
+                    if reason:
+                        responses.close()
+                        return aborted(reason)
+                    chunks.append(_chunk_text(chunk))
+                    chunk_offsets.append(time.monotonic() - started_at)
+
+            content = "".join(chunks)
+            duration = time.monotonic() - started_at
+            # モデル自体は応答しているため、空の結果でもブレーカーの失敗には数えない
+            derive_circuit_breaker.record_success(duration)
+            if not content.strip():
+                error_msg = f"派生コンテンツ生成エラー ({fmt}): モデルの応答が空でした（出力トークン上限に達した可能性があります）"
+                logger.warning(error_msg)
+                record("error", duration=duration, error=error_msg)
+                return _derive_result(article_id, fmt, error=error_msg, source="Error")
+            record("success", duration=duration)
+            logger.info(f"✅ 派生コンテンツ生成成功 ({fmt}): {len(content)}文字 / {duration:.1f}秒")
+            result = {
+                "success": True,
+                "content": content,
+                "format": fmt,
+                "article_id": article_id,
+                "source": DERIVE_MODEL_NAME if self.derive_model is not self.model else self.source,
+                "prompt_chars": len(prompt)
+            }
+            derived_cache.put(cache_key, result)
+            return result
+
+        except Exception as e:
+            reason = _abort_reason(cancel_event, deadline) if started_at is not None else None
+            if reason:
+                return aborted(reason)
+            error_msg = f"派生コンテンツ生成エラー ({fmt}): {str(e)}"
+            logger.error(error_msg)
+            if started_at is not None:
+                derive_circuit_breaker.record_failure(time.monotonic() - started_at, error_msg)
+                record("error", duration=time.monotonic() - started_at, error=str(e))
+            return _derive_result(article_id, fmt, error=error_msg, source="Error")
+
+    def _degraded_result(self, topic: str, category: str, tone: str):
+        """ブレーカー作動中の応答（保存済みの記事があればそれを返す）"""
+        stored = article_store.find(topic, category, tone)
+        if stored is not None:
+            logger.info(f"📦 ブレーカー作動中のため保存済み記事を返却: {stored['article_id']}")
+            return dict(stored, source=f"{stored['source']}（保存済み記事）", stale=True)
+        return {
+            "success": False,
+            "error": "Vertex AI が一時的に利用できません（サーキットブレーカー作動中）",
+            "content": f"# {topic}\n\nVertex AI が一時的に利用できません。しばらくしてから再度お試しください。",
+            "word_count": 0,
+            "source": "Circuit Breaker"
+        }
+
+
+def _percentile(values, q: float) -> float:
+    """単純な最近傍法によるパーセンタイル計算"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def _parse_client_weights(spec: str) -> dict:
+    """"key:weight,key:weight" 形式の重み設定を解析"""
+    weights = {}
+    for item in spec.split(","):
+        if ":" not in item:
+            continue
+        key, _, weight = item.strip().partition(":")
+        try:
+            weights[key] = max(float(weight), 0.01)
+        except ValueError:
+            logger.warning(f"⚠️ 不正なクライアント重み設定を無視: {item}")
+    return weights
+
+
+class _PriorityClass:
+    """優先度クラスごとの待ち行列と統計"""
+
+    def __init__(self, name: str, max_concurrency: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.queue = []  # (仮想終了時刻, 連番, future, クライアントキー)
+        self.virtual_time = 0.0
+        self.last_tag = {}
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.wait_times = deque(maxlen=1024)
+
+    def stats(self) -> dict:
+        waits = list(self.wait_times)
+        return {
+            "max_concurrency": self.max_concurrency,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "queue_wait_ms": {
+                "p50": round(_percentile(waits, 50) * 1000, 1),
+                "p95": round(_percentile(waits, 95) * 1000, 1),
+                "p99": round(_percentile(waits, 99) * 1000, 1),
+                "max": round(max(waits, default=0.0) * 1000, 1)
+            }
+        }
+
+
+class GenerationScheduler:
+    """BlogGenerator の前段に置く優先度付きスケジューラ
+
+    - 優先度クラス間は厳密優先（interactive が常に先）
+    - クラス内はクライアント/APIキー単位の重み付き公平キューイング
+    - 全体およびクラス別の同時実行数上限を持ち、バッチは空き枠のみを使う
+    """
+
+    def __init__(self, max_concurrency: int, class_limits: dict, client_weights: dict = None):
+        self.max_concurrency = max_concurrency
+        # 辞書の順序がそのまま優先順位になる
+        self.classes = {name: _PriorityClass(name, limit) for name, limit in class_limits.items()}
+        self.client_weights = client_weights or {}
+        self.running = 0
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: str, client_key: str):
+        """実行枠を獲得するまで待機"""
+        cls = self.classes[priority]
+        future = asyncio.get_running_loop().create_future()
+        enqueued_at = time.monotonic()
+
+        # 仮想終了時刻 = max(クラスの仮想時刻, 前回のタグ) + 1/重み
+        weight = self.client_weights.get(client_key, 1.0)
+        tag = max(cls.virtual_time, cls.last_tag.get(client_key, 0.0)) + 1.0 / weight
+        cls.last_tag[client_key] = tag
+        heapq.heappush(cls.queue, (tag, next(self._seq), future, client_key))
+        cls.queued += 1
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 枠を得た直後にキャンセルされた場合は返却する
+                self.release(priority)
+            else:
+                cls.queued -= 1
+            raise
+        cls.wait_times.append(time.monotonic() - enqueued_at)
+
+    def release(self, priority: str):
+        """実行枠を返却し、次の待機者を起動"""
+        cls = self.classes[priority]
+        cls.running -= 1
+        cls.completed += 1
+        self.running -= 1
+        self._dispatch()
+
+    def _next_class(self):
+        for cls in self.classes.values():
+            # キャンセル済みの待機者を先頭から取り除く
+            while cls.queue and cls.queue[0][2].done():
+                heapq.heappop(cls.queue)
+            if cls.queue and cls.running < cls.max_concurrency:
+                return cls
+        return None
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency:
+            cls = self._next_class()
+            if cls is None:
+                return
+            tag, _, future, _ = heapq.heappop(cls.queue)
+            cls.virtual_time = tag
+            # 仮想時刻以下のタグは順序に影響しないため破棄（未認証キーによる肥大化を防ぐ）
+            cls.last_tag = {key: t for key, t in cls.last_tag.items() if t > tag}
+            cls.queued -= 1
+            cls.running += 1
+            self.running += 1
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "classes": {name: cls.stats() for name, cls in self.classes.items()}
+        }
+
 # ブログ生成器初期化
 blog_generator = BlogGenerator()
+generation_scheduler = GenerationScheduler(
+    MAX_CONCURRENT_GENERATIONS,
+    {
+        PRIORITY_INTERACTIVE: INTERACTIVE_MAX_CONCURRENCY,
+        PRIORITY_BATCH: BATCH_MAX_CONCURRENCY
+    },
+    _parse_client_weights(CLIENT_WEIGHTS)
+)
+# 派生コンテンツは別モデルの枠を使うため独立したスケジューラで制御
+derive_scheduler = GenerationScheduler(
+    DERIVE_MAX_CONCURRENCY,
+    {
+        PRIORITY_INTERACTIVE: DERIVE_MAX_CONCURRENCY,
+        PRIORITY_BATCH: DERIVE_MAX_CONCURRENCY
+    },
+    _parse_client_weights(CLIENT_WEIGHTS)
+)
+
+
+def _resolve_timeout(timeout: Optional[float]) -> float:
+    """リクエスト指定の期限を上限内に丸める"""
+    if timeout is None or timeout <= 0:
+        return GENERATION_TIMEOUT_SECONDS
+    return min(timeout, MAX_GENERATION_TIMEOUT_SECONDS)
+
+
+async def _generate_with_deadline(request: Request, priority: str, client_key: str,
+                                  timeout: Optional[float], items: list,
+                                  func=None, scheduler: Optional[GenerationScheduler] = None,
+                                  on_cancel=None,
+                                  input_keys: tuple = ("topic", "category", "tone")) -> list:
+    """期限とクライアント切断を監視しながら各項目を生成
+
+    items は func に渡す引数のタプル（デフォルトは generate_blog の (topic, category, tone)）。
+    on_cancel(args, reason) は実行前にキャンセルされた項目の結果を作る。
+    input_keys は記録モードで items の各要素に付ける入力名。
+    期限切れまたは切断を検知すると、待機中の項目はキューから外し、
+    実行中の項目はストリームを中断させ、ワーカーが停止してから実行枠を返却する。
+    """
+    func = func or blog_generator.generate_blog
+    scheduler = scheduler or generation_scheduler
+    on_cancel = on_cancel or (lambda args, reason: _cancelled_result(args[0], reason))
+    # 記録モードで負荷形状を再現できるよう、枠の獲得前の到着時刻を残す
+    trace = {"arrived_at": time.time(), "priority": priority, "client": client_key, "timeout": timeout}
+    deadline = time.monotonic() + _resolve_timeout(timeout)
+    cancel_event = threading.Event()
+    started = [False] * len(items)
+
+    async def job(index, args):
+        await scheduler.acquire(priority, client_key)
+        started[index] = True
+        work = asyncio.ensure_future(run_in_threadpool(
+            func, *args,
+            cancel_event=cancel_event, deadline=deadline, trace=trace
+        ))
+        try:
+            return await asyncio.shield(work)
+        except asyncio.CancelledError:
+            # モデル呼び出しが実際に止まるまで枠を保持し、同時実行数の上限を守る
+            # 停止しないワーカーが枠を占有し続けないよう、待機には上限を設ける
+            cancel_event.set()
+            grace_deadline = time.monotonic() + CANCEL_GRACE_SECONDS
+            while not work.done():
+                remaining = grace_deadline - time.monotonic()
+                if remaining <= 0:
+                    cancellation_stats.record_abandoned_worker()
+                    logger.warning(f"⚠️ ワーカーが{CANCEL_GRACE_SECONDS:g}秒以内に停止しないため実行枠を解放します")
+                    break
+                try:
+                    await asyncio.wait({work}, timeout=remaining)
+                except asyncio.CancelledError:
+                    pass
+            raise
+        finally:
+            scheduler.release(priority)
+
+    tasks = [asyncio.ensure_future(job(i, args)) for i, args in enumerate(items)]
+    pending = set(tasks)
+    reason = None
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                reason = CANCEL_REASON_DEADLINE
+                break
+            _, pending = await asyncio.wait(pending, timeout=min(DISCONNECT_POLL_INTERVAL, remaining))
+            if pending and await request.is_disconnected():
+                reason = CANCEL_REASON_DISCONNECT
+                break
+    except asyncio.CancelledError:
+        # サーバー側でハンドラがキャンセルされた場合も同様に後始末する
+        reason = CANCEL_REASON_DISCONNECT
+        raise
+    finally:
+        if reason is not None and pending:
+            cancel_event.set()
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            running = sum(1 for i, task in enumerate(tasks) if task in pending and started[i])
+            if blog_generator.recorder:
+                # 待機中にキャンセルされたリクエストも到着パターンとして記録する
+                for i, task in enumerate(tasks):
+                    if task in pending and not started[i]:
+                        blog_generator.recorder.record(
+                            dict(zip(input_keys, items[i])), trace, "cancelled", error=reason
+                        )
+            cancellation_stats.record_cancel(reason, len(pending) - running, running)
+            logger.warning(f"⏹️ 生成をキャンセル ({reason}): 待機中 {len(pending) - running}件 / 実行中 {running}件")
+
+    return [
+        task.result() if not task.cancelled() else on_cancel(args, reason)
+        for task, args in zip(tasks, items)
+    ]
+
+
+def _client_key(request: Request, api_key: Optional[str] = None) -> str:
+    """公平キューイング用のクライアント識別子（APIキー優先）"""
+    if api_key:
+        return api_key
+    return request.client.host if request.client else "anonymous"
+
+
+def _resolve_priority(priority: str, api_key: Optional[str] = None, trusted: bool = False) -> str:
+    """API 経由の優先度を決定
+
+    インタラクティブ優先度は INTERACTIVE_API_KEYS に登録されたキー
+    （またはリプレイなど内部からの trusted な投入）のみ指定可能。
+    それ以外や不明な優先度はバッチとして扱う。
+    """
+    if priority == PRIORITY_INTERACTIVE and (trusted or api_key in INTERACTIVE_API_KEYS):
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_BATCH
 
 @app.get("/", response_class=HTMLResponse)
 async def home():
@@ -178,6 +1258,11 @@ async def home():
     status = "✅ 利用可能" if blog_generator.available else "❌ 利用不可"
     status_color = "#28a745" if blog_generator.available else "#dc3545"
     error_detail = blog_generator.error_message if not blog_generator.available else "Gemini 2.5 Pro モデル初期化完了"
+    breaker_state = circuit_breaker.stats()["state"]
+    if blog_generator.available and breaker_state != CircuitBreaker.CLOSED:
+        status = "⚠️ 一時的に不安定"
+        status_color = "#ffc107"
+        error_detail = "Vertex AI の応答が不安定なため、サーキットブレーカーが作動しています"
     
     return HTMLResponse(f"""
 <!DOCTYPE html>
@@ -493,15 +1578,20 @@ async def home():
 
 @app.post("/generate", response_class=HTMLResponse)
 async def generate(
+    request: Request,
     topic: str = Form(...), 
     category: str = Form("tech"), 
-    tone: str = Form("professional")
+    tone: str = Form("professional"),
+    timeout: Optional[float] = Form(None)
 ):
     """ブログ生成エンドポイント（長文対応）"""
     logger.info(f"🤖 長文ブログ生成リクエスト受信: {topic[:50]}...")
     
-    # AI生成実行
-    result = blog_generator.generate_blog(topic, category, tone)
+    # AI生成実行（UIからの操作はインタラクティブ優先度）
+    [result] = await _generate_with_deadline(
+        request, PRIORITY_INTERACTIVE, _client_key(request), timeout,
+        [(topic, category, tone)]
+    )
     
     # 結果に応じた表示設定
     if result["success"]:
@@ -736,12 +1826,163 @@ async def generate(
 </html>
 """)
 
+class GenerateRequest(BaseModel):
+    topic: str
+    category: str = "tech"
+    tone: str = "professional"
+    timeout: Optional[float] = None
+
+
+class BatchGenerateRequest(BaseModel):
+    items: List[GenerateRequest]
+    timeout: Optional[float] = None
+
+
+@app.post("/api/generate")
+async def api_generate(
+    body: GenerateRequest,
+    request: Request,
+    x_api_key: Optional[str] = Header(None),
+    priority: str = PRIORITY_BATCH
+):
+    """API経由のブログ生成（バッチ優先度。許可された APIキーのみ interactive を指定可能）"""
+    [result] = await _generate_with_deadline(
+        request, _resolve_priority(priority, x_api_key), _client_key(request, x_api_key), body.timeout,
+        [(body.topic, body.category, body.tone)]
+    )
+    return result
+
+
+@app.post("/api/generate/batch")
+async def api_generate_batch(
+    body: BatchGenerateRequest,
+    request: Request,
+    x_api_key: Optional[str] = Header(None)
+):
+    """一括生成（空き枠のみを使うバッチ優先度で実行）"""
+    client_key = _client_key(request, x_api_key)
+    logger.info(f"📦 一括生成リクエスト受信: {len(body.items)}件 ({client_key})")
+    results = await _generate_with_deadline(
+        request, PRIORITY_BATCH, client_key, body.timeout,
+        [(item.topic, item.category, item.tone) for item in body.items]
+    )
+    return {"count": len(results), "results": results}
+
+
+class DeriveRequest(BaseModel):
+    formats: List[str] = list(DERIVED_FORMATS)
+    timeout: Optional[float] = None
+
+
+class PackageRequest(GenerateRequest):
+    formats: List[str] = list(DERIVED_FORMATS)
+
+
+def _validate_formats(formats: List[str]) -> List[str]:
+    """未対応のフォーマットを 422 で拒否し、重複を除いた一覧を返す"""
+    unknown = [fmt for fmt in formats if fmt not in DERIVED_FORMATS]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"未対応のフォーマット: {', '.join(unknown)}")
+    return list(dict.fromkeys(formats))  # 重複したフォーマットは1回だけ生成
+
+
+@app.get("/api/articles/{article_id}")
+async def get_article(article_id: str):
+    """保存済み記事の取得"""
+    article = article_store.get(article_id)
+    if article is None:
+        raise HTTPException(status_code=404, detail="記事が見つかりません")
+    return article
+
+
+@app.post("/api/articles/{article_id}/derive")
+async def derive_article(
+    article_id: str,
+    body: DeriveRequest,
+    request: Request,
+    x_api_key: Optional[str] = Header(None),
+    priority: str = PRIORITY_BATCH
+):
+    """保存済み記事から派生コンテンツ（要約・翻訳など）を並列生成"""
+    if article_store.get(article_id) is None:
+        raise HTTPException(status_code=404, detail="記事が見つかりません")
+    formats = _validate_formats(body.formats)
+    results = await _generate_with_deadline(
+        request, _resolve_priority(priority, x_api_key), _client_key(request, x_api_key), body.timeout,
+        [(article_id, fmt) for fmt in formats],
+        func=blog_generator.derive, scheduler=derive_scheduler,
+        on_cancel=lambda args, reason: _derive_cancelled_result(*args, reason),
+        input_keys=("article_id", "format")
+    )
+    return {"article_id": article_id, "derived": dict(zip(formats, results))}
+
+
+@app.post("/api/package")
+async def generate_package(
+    body: PackageRequest,
+    request: Request,
+    x_api_key: Optional[str] = Header(None),
+    priority: str = PRIORITY_BATCH
+):
+    """記事1本を生成し、その本文から派生フォーマットをまとめて作成"""
+    started_at = time.monotonic()
+    formats = _validate_formats(body.formats)
+    priority = _resolve_priority(priority, x_api_key)
+    client_key = _client_key(request, x_api_key)
+    [article] = await _generate_with_deadline(
+        request, priority, client_key, body.timeout,
+        [(body.topic, body.category, body.tone)]
+    )
+    derived = {}
+    if article["success"]:
+        # 派生は記事生成で残った期限内に収める
+        remaining = _resolve_timeout(body.timeout) - (time.monotonic() - started_at)
+        results = await _generate_with_deadline(
+            request, priority, client_key, max(remaining, 0.001),
+            [(article["article_id"], fmt) for fmt in formats],
+            func=blog_generator.derive, scheduler=derive_scheduler,
+            on_cancel=lambda args, reason: _derive_cancelled_result(*args, reason),
+            input_keys=("article_id", "format")
+        )
+        derived = dict(zip(formats, results))
+    return {
+        "article": article,
+        "derived": derived,
+        "elapsed_seconds": round(time.monotonic() - started_at, 2)
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """スケジューラの待ち行列・待ち時間・キャンセル数メトリクス"""
+    return {
+        "scheduler": generation_scheduler.stats(),
+        "cancellations": cancellation_stats.stats(),
+        "derive_scheduler": derive_scheduler.stats(),
+        "derived_cache": derived_cache.stats()
+    }
+
+
 @app.get("/health")
 async def health_check():
-    """ヘルスチェックエンドポイント"""
+    """ヘルスチェックエンドポイント（ブレーカー状態・直近のエラー率・p95レイテンシを含む）"""
+    breaker = circuit_breaker.stats()
+    derive_breaker = derive_circuit_breaker.stats()
+    if not blog_generator.available:
+        status = "unhealthy"
+    elif breaker["state"] == CircuitBreaker.CLOSED and derive_breaker["state"] == CircuitBreaker.CLOSED:
+        status = "healthy"
+    else:
+        status = "degraded"
     return {
-        "status": "healthy",
+        "status": status,
         "vertex_ai_available": blog_generator.available,
+        "circuit_breaker": breaker["state"],
+        "recent_error_rate": breaker["recent_error_rate"],
+        "model_latency_p95_seconds": breaker["latency_p95_seconds"],
+        "breaker": breaker,
+        "derive_circuit_breaker": derive_breaker,
+        "stored_articles": len(article_store),
         "project_id": PROJECT_ID,
         "location": LOCATION,
         "version": "2.0.0",
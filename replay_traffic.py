@@ -0,0 +1,149 @@
+"""生成トラフィックの再生ツール
+
+requests.jsonl 形式の入力（1行1リクエスト）または記録ファイルから、
+元の到着間隔を保ったまま BlogGenerator にリクエストを流し込む。
+モデル呼び出しは記録済みのレスポンスで再生されるため Gemini は呼ばれない。
+
+入力 JSONL の各行:
+    {"topic": "...", "category": "tech", "tone": "professional",
+     "priority": "batch", "client": "team-a", "at": 1.5, "timeout": 60}
+    （at は開始からの到着時刻（秒）。省略時は全件を同時に投入）
+
+記録ファイルを入力にした場合は、記録された到着時刻・優先度・クライアントキー・期限
+（キャンセル・ブレーカー拒否されたリクエストを含む）から負荷形状を再現する。
+派生コンテンツ（要約・翻訳）の記録は再生バックエンドの応答としてのみ使い、投入はしない。
+
+使い方:
+    # 本番で記録（GENERATION_RECORD_PATH を設定して起動）
+    GENERATION_RECORD_PATH=traffic.vbrec uvicorn main:app
+
+    # 記録された負荷形状をそのまま 10 倍速で再現
+    python replay_traffic.py traffic.vbrec --speed 10
+
+    # 任意の入力を記録済みレスポンスで再生
+    python replay_traffic.py requests.jsonl --replay traffic.vbrec
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+
+def _is_generation_log(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(8) == b"VBGREC1\n"
+
+
+def load_inputs(path: str, read_generation_log) -> list:
+    """JSONL または記録ファイルからリクエスト一覧を読み込む"""
+    if _is_generation_log(path):
+        items = []
+        for record in read_generation_log(path):
+            if "format" in record["inputs"]:
+                continue
+            items.append(dict(
+                record["inputs"],
+                # 旧形式の記録には到着時刻が無いため開始時刻で代用
+                at=record.get("arrived_at") or record["started_at"],
+                priority=record.get("priority") or "batch",
+                client=record.get("client") or "replay",
+                timeout=record.get("timeout")
+            ))
+        first = min((item["at"] for item in items), default=0.0)
+        for item in items:
+            item["at"] -= first
+        return items
+
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                items.append(json.loads(line))
+    return items
+
+
+class _ReplayRequest:
+    """切断しないクライアントとして _generate_with_deadline に渡すリクエスト"""
+
+    async def is_disconnected(self) -> bool:
+        return False
+
+
+async def run(items: list, speed: float, main) -> dict:
+    """到着時刻どおりにリクエストを投入し、優先度別のレイテンシを集計"""
+    latencies = {}
+    outcomes = {"success": 0, "failed": 0, "cancelled": 0}
+    start = time.monotonic()
+
+    async def fire(item):
+        at = float(item.get("at", 0.0))
+        timeout = item.get("timeout")
+        if speed > 0:
+            await asyncio.sleep(max(0.0, start + at / speed - time.monotonic()))
+            # チャンク間隔と同じ倍率で期限も縮める
+            timeout = timeout / speed if timeout else timeout
+        priority = main._resolve_priority(item.get("priority", main.PRIORITY_BATCH), trusted=True)
+        arrived = time.monotonic()
+        [result] = await main._generate_with_deadline(
+            _ReplayRequest(), priority, item.get("client", "replay"), timeout,
+            [(item["topic"], item.get("category", "tech"), item.get("tone", "professional"))]
+        )
+        latencies.setdefault(priority, []).append(time.monotonic() - arrived)
+        if result.get("cancelled"):
+            outcomes["cancelled"] += 1
+        else:
+            outcomes["success" if result["success"] else "failed"] += 1
+
+    await asyncio.gather(*[fire(item) for item in items])
+    return {
+        "requests": len(items),
+        **outcomes,
+        "elapsed_seconds": round(time.monotonic() - start, 2),
+        "latency_seconds": {
+            priority: {
+                "p50": round(main._percentile(values, 50), 3),
+                "p95": round(main._percentile(values, 95), 3),
+                "p99": round(main._percentile(values, 99), 3)
+            }
+            for priority, values in latencies.items()
+        },
+        "scheduler": main.generation_scheduler.stats(),
+        "breaker": main.circuit_breaker.stats()
+    }
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="生成トラフィックを記録済みレスポンスで再生")
+    parser.add_argument("inputs", help="requests.jsonl 形式の入力、または記録ファイル")
+    parser.add_argument("--replay", help="再生に使う記録ファイル（省略時は inputs が記録ファイルならそれを使用）")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="到着間隔とチャンク間隔の再生速度倍率（0 で待機なし）")
+    parser.add_argument("--concurrency", type=int, help="Gemini 同時実行数の上限")
+    args = parser.parse_args(argv)
+
+    replay_path = args.replay or (args.inputs if _is_generation_log(args.inputs) else None)
+    if not replay_path:
+        parser.error("--replay で記録ファイルを指定してください")
+
+    # main の読み込み前に再生モードを設定する
+    os.environ["GENERATION_REPLAY_PATH"] = replay_path
+    os.environ["GENERATION_REPLAY_SPEED"] = str(args.speed)
+    os.environ.pop("GENERATION_RECORD_PATH", None)
+    if args.concurrency:
+        os.environ["MAX_CONCURRENT_GENERATIONS"] = str(args.concurrency)
+    import main
+
+    if not main.blog_generator.available:
+        print(f"再生バックエンドを初期化できません: {main.blog_generator.error_message}", file=sys.stderr)
+        return 1
+
+    items = load_inputs(args.inputs, main.read_generation_log)
+    report = asyncio.run(run(items, args.speed, main))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())